@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк выбора хендлера: цепочка предикатов telebot против словарей Router (tasks_bot.Router).
+
+  python bench_dispatch.py                     — 12, 50 и 200 кнопок/состояний
+  python bench_dispatch.py --menus 12,500 --n 100000
+
+Цепочка повторяет прежнюю регистрацию: N хендлеров `msg.text == "…"`, за ними N хендлеров
+`get_state(msg.chat.id) == "…"`; перебор — через TeleBot._test_message_handler, как это делает telebot.
+Меряется только выбор хендлера, сами хендлеры пустые.
+"""
+
+import argparse
+import timeit
+from types import SimpleNamespace
+
+from telebot import TeleBot
+
+import tasks_bot as core
+
+STATE = {}
+
+def noop(m):
+    pass
+
+def build(n):
+    chain = TeleBot("0:unset", threaded=False)
+    router = core.Router(STATE.get)
+    for i in range(n):
+        chain.message_handler(func=lambda msg, t=f"кнопка {i}": msg.text == t)(noop)
+        router.text(f"кнопка {i}")(noop)
+    for i in range(n):
+        chain.message_handler(func=lambda msg, s=f"state_{i}": STATE.get(msg.chat.id) == s)(noop)
+        router.state(f"state_{i}")(noop)
+    return chain, router
+
+def chain_resolve(chain, m):
+    for h in chain.message_handlers:
+        if chain._test_message_handler(h, m):
+            return h
+    return None
+
+def message(text, chat_id=1):
+    return SimpleNamespace(text=text, content_type="text", chat=SimpleNamespace(id=chat_id))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--menus", default="12,50,200", help="число кнопок (и столько же состояний), через запятую")
+    ap.add_argument("--n", type=int, default=200000, help="итераций на замер")
+    args = ap.parse_args()
+
+    print(f"{'menus':>6} {'case':<12} {'chain, мкс':>11} {'router, мкс':>12} {'x':>7}")
+    for n in [int(x) for x in args.menus.split(",")]:
+        chain, router = build(n)
+        STATE[2] = f"state_{n - 1}"
+        cases = {
+            "first text": message("кнопка 0"),
+            "last text":  message(f"кнопка {n - 1}"),
+            "last state": message("свободный текст", chat_id=2),
+            "no match":   message("свободный текст"),
+        }
+        for name, m in cases.items():
+            assert (chain_resolve(chain, m) is None) == (router.resolve_message(m) is None)
+            t_chain = timeit.timeit(lambda: chain_resolve(chain, m), number=args.n) / args.n * 1e6
+            t_router = timeit.timeit(lambda: router.resolve_message(m), number=args.n) / args.n * 1e6
+            print(f"{n:>6} {name:<12} {t_chain:>11.3f} {t_router:>12.3f} {t_chain / t_router:>7.1f}")
+
+    r = core.ROUTER
+    print(f"\ntasks_bot.ROUTER: {len(r.commands)} команд, {len(r.texts)} кнопок, "
+          f"{len(r.states)} состояний, {len(r.actions)} действий")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+Синхронизация задач с Google Sheets: только диффы, батчами, в пределах квот API.
+
+Push: журнал task_changes (его пишет tasks_bot при включённом SHEETS_BACKEND) → задачи,
+      чьи значения отличаются от sheet_rows.row_hash → один batch_update на пачку
+      (соседние строки склеиваются в один диапазон). Удалённая задача — очистка её строки.
+      Первый запуск (sheet_rows пуст) выгружает все задачи порциями по id.
+Pull: одно чтение листа → строки, чей хэш отличается от сохранённого, правят задачу в БД
+      (колонки EDITABLE); строка без id, но с user_id и text — новая задача.
+      Если задача изменена в боте и ещё не выгружена — побеждает бот.
+
+Бэкенды с одинаковым API get_values()/batch_update(data):
+  GSpreadBackend — боевой (service-account, как в check_credentials.py);
+  MemoryBackend, CsvBackend — офлайн-фейки для локальной проверки без сети.
+
+  SHEETS_BACKEND=csv python sheets_sync.py   — один проход по ENV
+"""
+
+import csv
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+from datetime import timedelta
+
+from sqlalchemy import select, update, delete, func, or_
+from sqlalchemy.exc import IntegrityError
+
+import tasks_bot as core
+from tasks_bot import Task, TaskChange, SheetRow, SyncCursor, dstr, parse_date_str, parse_time_str, now_local
+
+log = logging.getLogger("tasksbot.sheets")
+
+SHEET_COLUMNS = ["id", "user_id", "date", "category", "subcategory", "text", "deadline", "status", "repeat_rule", "source"]
+EDITABLE      = ("date", "category", "subcategory", "text", "deadline", "status")
+COL = {name: i for i, name in enumerate(SHEET_COLUMNS)}
+
+LEASE_CURSOR     = "sheets_lease"
+BOOTSTRAP_CURSOR = "sheets_bootstrap"   # last_id: последний выгруженный Task.id; -1 — выгрузка завершена
+LEASE_SECONDS    = 600
+
+SYNC_STATS = {"passes": 0, "skipped_locked": 0, "read_requests": 0, "write_requests": 0,
+              "rows_pushed": 0, "rows_cleared": 0, "rows_pulled": 0, "rows_created": 0,
+              "quota_waits": 0, "errors": 0}
+core.STATS_PROVIDERS["sheets"] = lambda: dict(SYNC_STATS)
+
+# ========= A1 =========
+def col_letter(n):
+    s = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+def col_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - 64)
+    return n
+
+LAST_COL = col_letter(len(SHEET_COLUMNS))
+_A1 = re.compile(r"^([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$")
+
+def parse_a1(rng):
+    """'A2:J4' -> (row1, col1, row2, col2), всё 1-based."""
+    m = _A1.match(rng.split("!")[-1])
+    if not m:
+        raise ValueError(f"bad A1 range: {rng}")
+    c1, r1, c2, r2 = m.groups()
+    return int(r1), col_index(c1), int(r2 or r1), col_index(c2 or c1)
+
+def row_range(first_row, n_rows=1):
+    return f"A{first_row}:{LAST_COL}{first_row + n_rows - 1}"
+
+def coalesce_ranges(updates):
+    """{row: values} -> [{"range", "values"}], подряд идущие строки — одним диапазоном."""
+    data, block, start, prev = [], [], None, None
+    for r in sorted(updates):
+        if prev is not None and r == prev + 1:
+            block.append(updates[r])
+        else:
+            if block:
+                data.append({"range": row_range(start, len(block)), "values": block})
+            start, block = r, [updates[r]]
+        prev = r
+    if block:
+        data.append({"range": row_range(start, len(block)), "values": block})
+    return data
+
+# ========= БЭКЕНДЫ =========
+class MemoryBackend:
+    """Лист в памяти: list строк (list str). Считает запросы, как их посчитал бы Google."""
+    def __init__(self, rows=None):
+        self.grid = [list(r) for r in rows or []]
+        self.requests = {"read": 0, "write": 0}
+
+    def get_values(self):
+        self.requests["read"] += 1
+        return [list(r) for r in self.grid]
+
+    def batch_update(self, data):
+        self.requests["write"] += 1
+        for item in data:
+            r1, c1, _, _ = parse_a1(item["range"])
+            for i, vals in enumerate(item["values"]):
+                self._write_row(r1 + i, c1, vals)
+
+    def _write_row(self, row, col, vals):
+        while len(self.grid) < row:
+            self.grid.append([])
+        line = self.grid[row - 1]
+        need = col - 1 + len(vals)
+        if len(line) < need:
+            line.extend([""] * (need - len(line)))
+        line[col - 1:need] = ["" if v is None else str(v) for v in vals]
+
+class CsvBackend(MemoryBackend):
+    """Лист в CSV-файле: правки, сделанные в файле руками, видны следующему pull."""
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, newline="", encoding="utf-8") as f:
+                self.grid = [row for row in csv.reader(f)]
+
+    def get_values(self):
+        self._load()
+        return super().get_values()
+
+    def batch_update(self, data):
+        self._load()
+        super().batch_update(data)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(self.grid)
+        os.replace(tmp, self.path)
+
+class GSpreadBackend:
+    def __init__(self, credentials, spreadsheet, worksheet):
+        import gspread
+        gc = gspread.service_account(filename=credentials)
+        sh = gc.open_by_key(spreadsheet)
+        try:
+            self.ws = sh.worksheet(worksheet)
+        except gspread.WorksheetNotFound:
+            self.ws = sh.add_worksheet(worksheet, rows=1000, cols=len(SHEET_COLUMNS))
+
+    def get_values(self):
+        return self.ws.get_all_values()
+
+    def batch_update(self, data):
+        last_row = max(parse_a1(d["range"])[2] for d in data)
+        if last_row > self.ws.row_count:
+            self.ws.add_rows(last_row - self.ws.row_count + 500)
+        self.ws.batch_update(data, value_input_option="RAW")
+
+_BACKEND = {}
+
+def backend_from_config(cfg):
+    kind = cfg["SHEETS_BACKEND"]
+    if kind not in _BACKEND:
+        if kind == "gspread":
+            _BACKEND[kind] = GSpreadBackend(cfg["SHEETS_CREDENTIALS"], cfg["SHEETS_SPREADSHEET"], cfg["SHEETS_WORKSHEET"])
+        elif kind == "csv":
+            _BACKEND[kind] = CsvBackend(cfg["SHEETS_CSV_PATH"])
+        elif kind == "memory":
+            _BACKEND[kind] = MemoryBackend()
+        else:
+            raise ValueError(f"SHEETS_BACKEND: gspread | csv | memory, получено {kind!r}")
+    return _BACKEND[kind]
+
+# ========= КВОТА =========
+class QuotaWindow:
+    """Не больше per_min запросов за скользящие 60 секунд (квота Sheets — 60/мин на пользователя)."""
+    def __init__(self, per_min, clock=time.monotonic):
+        self.per_min = per_min
+        self.clock = clock
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            now = self.clock()
+            while self._calls and now - self._calls[0] >= 60:
+                self._calls.popleft()
+            if len(self._calls) >= self.per_min:
+                return False
+            self._calls.append(now)
+            return True
+
+_QUOTA = {}
+
+def quota_for(cfg):
+    n = cfg["SHEETS_WRITES_PER_MIN"]
+    if n not in _QUOTA:
+        _QUOTA[n] = QuotaWindow(n)
+    return _QUOTA[n]
+
+class QuotaExhausted(Exception):
+    pass
+
+def _request(quota, kind, fn, *args):
+    if not quota.try_acquire():
+        SYNC_STATS["quota_waits"] += 1
+        raise QuotaExhausted()
+    SYNC_STATS[f"{kind}_requests"] += 1
+    return fn(*args)
+
+# ========= ЗНАЧЕНИЯ =========
+def task_values(t):
+    """Значения строки листа; нормализованы так же, как pad() нормализует прочитанное с листа,
+    иначе задача с пробелами по краям текста выглядела бы правкой на каждом проходе."""
+    return [str(v).strip() for v in (
+        t.id, t.user_id, dstr(t.date), t.category or "", t.subcategory or "", t.text or "",
+        t.deadline.strftime("%H:%M") if t.deadline else "", t.status or "", t.repeat_rule or "", t.source or "")]
+
+def row_hash(vals):
+    return hashlib.sha1("\x1f".join(vals).encode("utf-8")).hexdigest()
+
+def pad(vals):
+    vals = [str(v).strip() for v in vals[:len(SHEET_COLUMNS)]]
+    return vals + [""] * (len(SHEET_COLUMNS) - len(vals))
+
+def apply_values(t, vals):
+    """Редактируемые колонки листа -> поля задачи. ValueError при кривой дате/времени."""
+    t.date        = parse_date_str(vals[COL["date"]]) if vals[COL["date"]] else t.date
+    t.category    = vals[COL["category"]] or "Личное"
+    t.subcategory = vals[COL["subcategory"]]
+    t.text        = vals[COL["text"]] or t.text
+    t.deadline    = parse_time_str(vals[COL["deadline"]]) if vals[COL["deadline"]] else None
+    t.status      = vals[COL["status"]]
+    t.kind        = core.task_kind(t.text, t.source)
+
+# ========= АРЕНДА =========
+def _cursor(sess, name, default_id=0):
+    c = sess.get(SyncCursor, name)
+    if c is None:
+        try:
+            sess.add(SyncCursor(name=name, last_id=default_id))
+            sess.commit()
+        except IntegrityError:
+            sess.rollback()
+        c = sess.get(SyncCursor, name)
+    return c
+
+def acquire_lease(sess, seconds=LEASE_SECONDS):
+    _cursor(sess, LEASE_CURSOR)
+    now = core.utcnow()
+    res = sess.execute(update(SyncCursor)
+                       .where(SyncCursor.name==LEASE_CURSOR,
+                              or_(SyncCursor.locked_until==None, SyncCursor.locked_until < now))
+                       .values(locked_until=now + timedelta(seconds=seconds)))
+    sess.commit()
+    return res.rowcount == 1
+
+def release_lease(sess):
+    sess.execute(update(SyncCursor).where(SyncCursor.name==LEASE_CURSOR).values(locked_until=None))
+    sess.commit()
+
+# ========= PULL =========
+def pull(sess, values):
+    """Правки из листа -> БД. Возвращает id задач, которые надо перезаписать на листе (нормализация, новые id)."""
+    repush = []
+    if not values:
+        return repush
+    by_id = {r.task_id: r for r in sess.scalars(select(SheetRow))}
+    pending = set(sess.scalars(select(TaskChange.task_id).distinct()))
+    edited, created = {}, []
+    for rownum, raw in enumerate(values[1:], start=2):
+        vals = pad(raw)
+        if not any(vals):
+            continue
+        if not vals[COL["id"]]:
+            if vals[COL["user_id"]].lstrip("-").isdigit() and vals[COL["text"]]:
+                created.append((rownum, vals))
+            continue
+        if not vals[COL["id"]].isdigit():
+            continue
+        m = by_id.get(int(vals[COL["id"]]))
+        if m is None:
+            continue
+        if m.row != rownum:
+            m.row = rownum          # строку передвинули (сортировка на листе)
+        if row_hash(vals) != m.row_hash and m.task_id not in pending:
+            edited[m.task_id] = vals
+
+    sess.info["skip_changelog"] = True
+    try:
+        if edited:
+            for t in sess.scalars(select(Task).where(Task.id.in_(list(edited)))):
+                try:
+                    apply_values(t, edited[t.id])
+                except ValueError as e:
+                    log.warning("sheets: row for task %s ignored: %s", t.id, e)
+                    continue
+                repush.append(t.id)
+        new_rows = []
+        for rownum, vals in created:
+            try:
+                uid = int(vals[COL["user_id"]])
+                t = Task(user_id=uid, date=now_local(uid).date(), text=vals[COL["text"]],
+                         repeat_rule=vals[COL["repeat_rule"]], source=vals[COL["source"]] or "sheets",
+                         is_repeating=bool(vals[COL["repeat_rule"]]))
+                apply_values(t, vals)
+            except ValueError as e:
+                log.warning("sheets: new row %s ignored: %s", rownum, e)
+                continue
+            sess.add(t)
+            new_rows.append((rownum, t))
+        sess.flush()
+        for rownum, t in new_rows:
+            sess.add(SheetRow(task_id=t.id, row=rownum, row_hash=""))
+            repush.append(t.id)
+        sess.commit()
+    finally:
+        sess.info.pop("skip_changelog", None)
+    SYNC_STATS["rows_pulled"] += len(edited)
+    SYNC_STATS["rows_created"] += len(new_rows)
+    return repush
+
+# ========= PUSH =========
+def push_tasks(sess, backend, quota, task_ids, extra=None):
+    """Один batch_update на пачку task_ids (плюс extra — {row: values}). Коммитит хэши после записи."""
+    ids = list(dict.fromkeys(task_ids))
+    tasks = {t.id: t for t in sess.scalars(select(Task).where(Task.id.in_(ids)))} if ids else {}
+    rows  = {r.task_id: r for r in sess.scalars(select(SheetRow).where(SheetRow.task_id.in_(ids)))} if ids else {}
+    next_row = (sess.scalar(select(func.max(SheetRow.row))) or 1) + 1
+    updates = dict(extra or {})
+    cleared = 0
+    for tid in ids:
+        t, sr = tasks.get(tid), rows.get(tid)
+        if t is None:
+            if sr is not None:
+                updates[sr.row] = [""] * len(SHEET_COLUMNS)
+                sess.delete(sr)
+                cleared += 1
+            continue
+        vals = task_values(t)
+        h = row_hash(vals)
+        if sr is not None and sr.row_hash == h:
+            continue
+        if sr is None:
+            sr = SheetRow(task_id=tid, row=next_row)
+            next_row += 1
+            sess.add(sr)
+        sr.row_hash = h
+        updates[sr.row] = vals
+    if updates:
+        try:
+            _request(quota, "write", backend.batch_update, coalesce_ranges(updates))
+        except Exception:
+            sess.rollback()
+            raise
+    sess.commit()
+    SYNC_STATS["rows_pushed"] += len(updates) - cleared - len(extra or {})
+    SYNC_STATS["rows_cleared"] += cleared
+    return len(updates)
+
+def push(sess, backend, quota, batch, extra=None):
+    boot = _cursor(sess, BOOTSTRAP_CURSOR, default_id=0 if not sess.scalar(select(func.count()).select_from(SheetRow)) else -1)
+    # первичная выгрузка всего, порциями по id
+    while boot.last_id != -1:
+        ids = list(sess.scalars(select(Task.id).where(Task.id > boot.last_id).order_by(Task.id).limit(batch)))
+        if ids:
+            push_tasks(sess, backend, quota, ids, extra)
+            extra = None
+            boot.last_id = ids[-1]
+        if len(ids) < batch:
+            boot.last_id = -1
+        sess.commit()
+    # дальше — только журнал изменений
+    while True:
+        changes = sess.execute(select(TaskChange.id, TaskChange.task_id).order_by(TaskChange.id).limit(batch)).all()
+        if not changes and not extra:
+            return
+        push_tasks(sess, backend, quota, [c.task_id for c in changes], extra)
+        extra = None
+        if changes:
+            sess.execute(delete(TaskChange).where(TaskChange.id <= changes[-1].id))
+            sess.commit()
+        if len(changes) < batch:
+            return
+
+# ========= ПРОХОД =========
+def run_sync(sess, backend, cfg=None):
+    """Pull, затем push. Из нескольких воркеров работает тот, кто взял аренду."""
+    cfg = cfg or core.CONFIG
+    if not acquire_lease(sess):
+        SYNC_STATS["skipped_locked"] += 1
+        return False
+    quota = quota_for(cfg)
+    try:
+        SYNC_STATS["passes"] += 1
+        values = _request(quota, "read", backend.get_values)
+        extra = None
+        if not values or pad(values[0]) != SHEET_COLUMNS:
+            extra = {1: list(SHEET_COLUMNS)}
+        repush = pull(sess, values)
+        if repush:
+            push_tasks(sess, backend, quota, repush)
+        push(sess, backend, quota, cfg["SHEETS_BATCH_RANGES"], extra)
+        return True
+    except QuotaExhausted:
+        log.info("sheets: quota window exhausted, continuing next pass")
+        return True
+    except Exception as e:
+        SYNC_STATS["errors"] += 1
+        log.error("sheets sync error: %s", e)
+        sess.rollback()
+        return False
+    finally:
+        release_lease(sess)
+
+if __name__ == "__main__":
+    cfg = core.load_config()
+    if not cfg["DATABASE_URL"] or not cfg["SHEETS_BACKEND"]:
+        raise SystemExit("Нужны ENV: DATABASE_URL, SHEETS_BACKEND")
+    core.apply_config(cfg)
+    from sqlalchemy import create_engine
+    core.engine = create_engine(core.DB_URL, **core.engine_kwargs(core.DB_URL, cfg))
+    core.SessionLocal.configure(bind=core.engine)
+    core.init_db()
+    sess = core.SessionLocal()
+    try:
+        run_sync(sess, backend_from_config(cfg), cfg)
+        print(SYNC_STATS)
+    finally:
+        core.SessionLocal.remove()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Симуляция планировщика на ручных часах: месяц работы бота для тысяч пользователей без ожидания.
+
+  python sim_scheduler.py                                   — 2000 пользователей, 30 дней, SQLite во временной папке (~5 мин)
+  python sim_scheduler.py --users 200 --days 7              — быстрая проверка (~15 с)
+  python sim_scheduler.py --users 5000 --db postgresql+psycopg2://…/sim --seed 7
+
+Время двигает tasks_bot.SimClock: планировщик (tasks_bot.Scheduler с теми же job'ами, что в проде) после
+каждого прохода перескакивает прямо к ближайшему созревшему job'у, так что все минутные тики дайджестов и
+напоминаний выполняются, но без ожидания. Telegram подменён записью сообщений в список (через outbox, как в
+проде). Пользователи — в разных поясах (с переходами на летнее время внутри марта), со своим временем
+дайджеста или без него, с повторяющимися задачами и разовыми напоминаниями.
+
+Холостой тик почти ничего не стоит (напоминания и дайджесты — в куче по UTC, отправщик outbox без работы в БД
+не ходит), так что время — это сами дайджесты и отправки: ~54 тыс. дайджестов по ~3,5 мс в полном прогоне.
+
+Печатается по каждому job'у: запусков, суммарное и максимальное время, SQL-запросов (DB_STATS), сообщений.
+Затем проверки, каждая — OK/FAIL с примерами:
+  reminders — каждое напоминание пришло ровно один раз и не раньше/не сильно позже своего времени;
+  digests   — ровно один дайджест на пользователя в каждый его локальный день, вовремя; у «выкл» — ни одного;
+  repeats   — экземпляры повторяющихся задач ровно в те дни, когда repeat_due, без дублей.
+Код выхода 1, если хоть одна проверка не прошла.
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+from collections import Counter, defaultdict
+from datetime import date as date_cls, datetime, time as time_cls, timedelta
+
+import pytz
+from sqlalchemy import event
+
+import tasks_bot as core
+
+ZONES = ["Europe/Moscow", "Europe/Samara", "Europe/Berlin", "America/New_York", "Asia/Tokyo", "Asia/Kolkata"]
+TEMPLATES = [                     # (текст, правило) — у каждого пользователя все три
+    ("планёрка", "каждые 1 дн"),
+    ("полив цветов", "каждые 3 дн"),
+    ("отчёт", "по пн, ср, пт"),
+]
+
+class SimScheduler(core.Scheduler):
+    """Scheduler, который ещё считает SQL-запросы и сообщения каждого job'а."""
+    def __init__(self, outbox):
+        super().__init__()
+        self.outbox = outbox
+        self.sql = Counter()
+        self.msgs = Counter()
+
+    def run(self, job):
+        q0, m0 = core.DB_STATS["statements"], len(self.outbox)
+        super().run(job)
+        self.sql[job.__name__] += core.DB_STATS["statements"] - q0
+        self.msgs[job.__name__] += len(self.outbox) - m0
+
+def seed(n_users, start, days, reminders, rnd):
+    """Пользователи, шаблоны повторов и напоминания -> (users, expected reminders)."""
+    sess = core.SessionLocal()
+    users, expect = {}, {}
+    for uid in range(1, n_users + 1):
+        tz = rnd.choice(ZONES)
+        digest = "off" if rnd.random() < 0.1 else f"{rnd.randint(6, 10):02d}:{rnd.randint(0, 59):02d}"
+        users[uid] = (pytz.timezone(tz), None if digest == "off" else core.parse_time_str(digest))
+        sess.add(core.User(id=uid, name=f"sim{uid}", tz=tz, digest_time=digest))
+        local0 = start.astimezone(users[uid][0]).date()
+        for text, rule in TEMPLATES:
+            sess.add(core.Task(user_id=uid, date=local0, category="Сим", subcategory="", text=text, status="",
+                               repeat_rule=rule, source="", is_repeating=True,
+                               created_at=datetime.combine(local0, time_cls())))
+        for i in range(reminders):
+            t = core.Task(user_id=uid, date=local0, category="Сим", subcategory="", text=f"напомнить {uid}/{i}",
+                          status="", repeat_rule="", source="", is_repeating=False)
+            sess.add(t)
+            sess.flush()
+            at = start + timedelta(minutes=rnd.randint(1, days * 24 * 60 - 30))
+            local = at.astimezone(users[uid][0])
+            r = core.Reminder(user_id=uid, task_id=t.id, date=local.date(),
+                              time=local.time().replace(second=0, microsecond=0),
+                              due_at=at.replace(second=0, microsecond=0, tzinfo=None), fired=False)
+            sess.add(r)
+            expect[(uid, t.text)] = at.replace(second=0, microsecond=0)
+        if uid % 500 == 0:
+            sess.commit()
+    sess.commit()
+    core.SessionLocal.remove()
+    return users, expect
+
+def simulate(sched, clock, end):
+    core.scheduler_start(sched)
+    ticks = 0
+    while clock.now() < end:
+        sched.run_pending()
+        ticks += 1
+        clock.set(min(sched.next_run(), end))
+    sched.run_pending()
+    return ticks
+
+def check(name, errors, total):
+    print(f"{name:<10} {'OK' if not errors else 'FAIL'}  {total - len(errors)}/{total}"
+          + "".join(f"\n    {e}" for e in errors[:5]))
+    return not errors
+
+def check_reminders(outbox, expect, slack):
+    got = defaultdict(list)
+    for uid, text, at in outbox:
+        if text.startswith("⏰"):
+            got[(uid, text.split(" — ", 1)[1].rsplit(" (до", 1)[0])].append(at)
+    errors = []
+    for key, due in expect.items():
+        sent = got.get(key, [])
+        if len(sent) != 1:
+            errors.append(f"{key}: отправлено {len(sent)} раз, ждали 1 (в {due:%d.%m %H:%M} UTC)")
+        elif not (due <= sent[0] <= due + slack):
+            errors.append(f"{key}: пришло в {sent[0]:%d.%m %H:%M:%S}, ждали {due:%d.%m %H:%M} UTC")
+    return check("reminders", errors, len(expect))
+
+def digest_days(tz, dt, start, end, slack):
+    """Локальные дни, дайджест которых должен уйти внутри [start, end - slack]."""
+    day, out = start.astimezone(tz).date(), {}
+    while True:
+        fire = tz.localize(datetime.combine(day, dt)).astimezone(pytz.utc)
+        if fire > end - slack:
+            return out
+        if fire > start:
+            out[day] = fire
+        day += timedelta(days=1)
+
+def tail_days(tz, dt, end, slack):
+    """Дни, чей дайджест пришёлся на последние slack окна: мог уйти, а мог и не успеть — не проверяем."""
+    return digest_days(tz, dt, end - slack, end, timedelta(0)) if dt else {}
+
+def check_digests(outbox, users, start, end, slack):
+    got = defaultdict(list)
+    for uid, text, at in outbox:
+        if text.startswith("📅 План на "):
+            got[(uid, core.parse_date_str(text.split("\n", 1)[0][len("📅 План на "):]))].append(at)
+    errors, total = [], 0
+    for uid, (tz, dt) in users.items():
+        want = digest_days(tz, dt, start, end, slack) if dt else {}
+        total += max(1, len(want))
+        for day, fire in want.items():
+            sent = got.pop((uid, day), [])
+            if len(sent) != 1:
+                errors.append(f"user {uid} ({tz.zone}, {dt}): {day}: дайджестов {len(sent)}")
+            elif not (fire <= sent[0] <= fire + slack):
+                errors.append(f"user {uid} ({tz.zone}, {dt}): {day}: в {sent[0]:%H:%M:%S}, ждали {fire:%H:%M} UTC")
+        for day in tail_days(tz, dt, end, slack):
+            got.pop((uid, day), None)
+    errors += [f"user {uid}: лишний дайджест за {day} ({len(sent)})" for (uid, day), sent in got.items()]
+    return check("digests", errors, total)
+
+def check_repeats(users, start, end, slack):
+    sess = core.SessionLocal()
+    templates = {(t.user_id, t.text): t for t in sess.query(core.Task).filter(core.Task.is_repeating == True)}
+    have = Counter((r.user_id, r.text, r.date) for r in sess.query(core.Task.user_id, core.Task.text, core.Task.date)
+                   .filter(core.Task.source == "repeat-instance"))
+    core.SessionLocal.remove()
+    errors, total = [], 0
+    for (uid, text), tp in templates.items():
+        tz, dt = users[uid]
+        days = digest_days(tz, dt, start, end, slack) if dt else {}
+        for day in days:
+            want = int(core.repeat_due(tp, day)[0] and day != tp.date)   # в день шаблона он сам и есть задача
+            total += 1
+            if have.pop((uid, text, day), 0) != want:
+                errors.append(f"user {uid} «{text}» ({tp.repeat_rule}) {day}: ждали {want}")
+    for (uid, text, day), n in have.items():
+        if day not in tail_days(*users[uid], end, slack):
+            errors.append(f"user {uid} «{text}» {day}: лишних экземпляров {n}")
+    return check("repeats", errors, total)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--days", type=int, default=30)
+    ap.add_argument("--start", default="2026-03-02", help="день начала (UTC), по умолчанию — месяц с переходами на летнее время")
+    ap.add_argument("--reminders", type=int, default=3, help="разовых напоминаний на пользователя")
+    ap.add_argument("--outbox-every", type=int, default=5, help="OUTBOX_EVERY_SEC для симуляции, сек (как в проде)")
+    ap.add_argument("--db", default="", help="DATABASE_URL; по умолчанию — SQLite во временной папке")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    db = args.db or "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="sim_scheduler_"), "sim.db")
+    start = pytz.utc.localize(datetime.combine(date_cls.fromisoformat(args.start), time_cls()))
+    end = start + timedelta(days=args.days)
+    slack = timedelta(seconds=60 + args.outbox_every + 1)   # тик планировщика + отправщик outbox
+
+    clock = core.SimClock(start)
+    core.CLOCK = clock
+    core.create_app({"TELEGRAM_TOKEN": "0:sim", "WEBHOOK_BASE": "http://sim", "DATABASE_URL": db,
+                     "OUTBOX_EVERY_SEC": args.outbox_every, "TRACE_SAMPLE": 0})
+    core.init_database()
+    if core.engine.dialect.name == "sqlite":
+        # fsync на каждый commit меряет диск, а не планировщик
+        event.listen(core.engine, "connect", lambda dbapi_conn, rec: dbapi_conn.execute("PRAGMA synchronous=OFF"))
+        core.engine.dispose()
+    outbox = []
+    core.bot.send_message = lambda chat_id, text, **kw: outbox.append((chat_id, text, clock.now()))
+
+    t0 = time.perf_counter()
+    users, expect = seed(args.users, start, args.days, args.reminders, random.Random(args.seed))
+    print(f"seed: {args.users} пользователей, {len(expect)} напоминаний, {time.perf_counter() - t0:.1f} с")
+
+    sched = core.setup_scheduler(SimScheduler(outbox))
+    q0, t0 = core.DB_STATS["statements"], time.perf_counter()
+    ticks = simulate(sched, clock, end)
+    wall = time.perf_counter() - t0
+    print(f"simulated {start:%d.%m.%Y} — {end:%d.%m.%Y}: {ticks} проходов, {wall:.1f} с, "
+          f"{core.DB_STATS['statements'] - q0} SQL, {len(outbox)} сообщений\n")
+
+    print(f"{'job':<20} {'runs':>7} {'total, с':>9} {'avg, мс':>8} {'max, мс':>8} {'SQL':>9} {'SQL/run':>8} {'msgs':>7} {'err':>4}")
+    for name, st in sorted(sched.stats.items(), key=lambda kv: -kv[1]["ms"]):
+        print(f"{name:<20} {st['runs']:>7} {st['ms'] / 1000:>9.2f} {st['ms'] / st['runs']:>8.2f} {st['max_ms']:>8.1f} "
+              f"{sched.sql[name]:>9} {sched.sql[name] / st['runs']:>8.1f} {sched.msgs[name]:>7} {st['errors']:>4}")
+    print()
+
+    ok = check_reminders(outbox, expect, slack)
+    ok &= check_digests(outbox, users, start, end, slack)
+    ok &= check_repeats(users, start, end, slack)
+    print(f"\noutbox: {core.OUTBOX_STATS}")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,990 @@
+# -*- coding: utf-8 -*-
+"""
+TasksBot — asyncio-режим: AsyncTeleBot + async SQLAlchemy + AsyncOpenAI в одном процессе aiohttp.
+
+Те же хендлеры, что и в tasks_bot.py, но без блокировок: ожидание Telegram, Postgres и GPT
+не держит поток, поэтому один процесс обслуживает тысячи апдейтов одновременно.
+Вся предметная логика (правила повторов и поставщиков, форматирование, клавиатуры,
+состояния) берётся из tasks_bot.py — здесь только async-доступ к данным и отправка.
+
+Запуск:
+  RUNTIME_MODE=async python tasks_bot.py
+  python tasks_bot_async.py
+ENV те же, что у tasks_bot.py. Драйвер БД подставляется сам: postgresql → asyncpg,
+sqlite → aiosqlite.
+"""
+
+import sys
+import time
+import uuid
+import asyncio
+import functools
+import logging
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from aiohttp import web
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+import tasks_bot as core
+from tasks_bot import (
+    Base, User, Task, SubTask, Supplier, Reminder, ProcessedUpdate,
+    now_local, dstr, parse_date_str, parse_time_str, parse_cb, short_task_line, format_grouped,
+    main_menu, supplies_menu, set_state, get_state, get_buf, clear_state,
+)
+
+log = logging.getLogger("tasksbot.async")
+
+abot = AsyncTeleBot(core.API_TOKEN or "0:unset", parse_mode="HTML")
+aengine = None
+areplicas = []
+aopenai = None
+ASession = async_sessionmaker(expire_on_commit=False, autoflush=False, sync_session_class=core.RoutingSession)
+
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+def async_db_url(url):
+    u = make_url(url)
+    backend = u.get_backend_name()
+    if backend in ASYNC_DRIVERS and u.get_driver_name() != ASYNC_DRIVERS[backend]:
+        u = u.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    return u
+
+def make_async_openai(api_key):
+    if not api_key:
+        return None
+    try:
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=api_key)
+    except Exception:
+        return None
+
+# ========= ДОСТУП К ДАННЫМ =========
+@asynccontextmanager
+async def read_only(sess, uid=None):
+    """Как core.read_only для AsyncSession: маршрут решает та же core.RoutingSession."""
+    info = sess.sync_session.info
+    if info.get("replica") is not None:
+        yield sess
+        return
+    if uid is not None and core.REPLICAS.engines and not core.REPLICAS.pinned(uid):
+        core.REPLICAS.pin(uid, (await sess.execute(select(User.last_write_at).where(User.id == uid))).scalar())
+    eng = core.REPLICAS.pick(uid)
+    if eng is not None:
+        info["replica"] = eng
+        try:
+            await sess.connection(bind_arguments={"bind": eng})
+        except DBAPIError as e:
+            info.pop("replica", None)
+            core.REPLICAS.mark_down(eng, e)
+    try:
+        yield sess
+    finally:
+        info.pop("replica", None)
+
+async def ensure_user(sess, uid, name=""):
+    u = await sess.get(User, uid)
+    if not u:
+        u = User(id=uid, name=name or "")
+        sess.add(u)
+        await sess.commit()
+        core.DIGESTS.schedule(uid, *core.PREFS.put(uid, "", ""))
+    return u
+
+async def get_tasks_for_date(sess, user_id, date):
+    return (await sess.scalars(core.q_tasks_for_date(user_id, date))).all()
+
+async def get_tasks_for_week(sess, user_id, base_date):
+    return (await sess.scalars(core.q_tasks_for_week(user_id, base_date))).all()
+
+async def get_task_views(sess, stmt):
+    """select(Task) -> [core.TaskView] (только колонки read-модели)."""
+    return core.task_views(await sess.execute(core.views(stmt)))
+
+async def get_user_task(sess, task_id, user_id):
+    return (await sess.scalars(select(Task).where(Task.id==task_id, Task.user_id==user_id))).first()
+
+async def add_task(sess, *, user_id, date, category, subcategory, text, deadline=None, repeat_rule="", source="", is_repeating=False):
+    t = Task(
+        user_id=user_id, date=date,
+        category=category or "Личное",
+        subcategory=subcategory or "",
+        text=text.strip(), deadline=deadline,
+        status="", repeat_rule=repeat_rule.strip(),
+        source=source.strip(), is_repeating=is_repeating
+    )
+    sess.add(t)
+    await sess.commit()
+    return t
+
+async def complete_task(sess, task_id, user_id):
+    t = await get_user_task(sess, task_id, user_id)
+    if not t: return None
+    t.status = "выполнено"
+    await sess.commit()
+    return t
+
+async def delete_task(sess, task_id, user_id):
+    t = await get_user_task(sess, task_id, user_id)
+    if not t: return False
+    await sess.delete(t)
+    await sess.commit()
+    return True
+
+@core.traced("expand_repeats")
+async def expand_repeats_for_date(sess, user_id, date):
+    templates = (await sess.execute(core.q_repeat_templates(user_id))).all()
+    existing = {tuple(r) for r in await sess.execute(core.q_task_keys_for_date(user_id, date))}
+    new = core.repeat_instances(templates, existing, user_id, date)
+    if new:
+        sess.add_all(new)
+        await sess.commit()
+
+async def plan_next_for_supplier(sess, user_id, supplier_name, category, subcategory, commit=True):
+    # календарь поставок — синхронный код ядра поверх той же транзакции
+    return await sess.run_sync(core.plan_next_for_supplier, user_id, supplier_name, category, subcategory, commit)
+
+# ========= OUTBOX =========
+async def enqueue(sess, chat_id, text, key, kind="", markup=None):
+    await sess.run_sync(core.enqueue, chat_id, text, key, kind, markup)
+
+async def drain_outbox(keys=None, rounds=10):
+    """Как core.drain_outbox: аренда и итог — короткими транзакциями, отправка — вне них."""
+    batch, total = core.CONFIG["OUTBOX_BATCH"], 0
+    if keys is None and not core.OUTBOX_WAKE.begin(core.utcnow()):
+        return 0
+    for _ in range(rounds):
+        token = uuid.uuid4().hex
+        async with aengine.begin() as conn:
+            rows = await conn.run_sync(core.claim_outbox, token, core.utcnow(), batch, keys)
+        if not rows:
+            break
+        results = []
+        for r in rows:
+            try:
+                await abot.send_message(r.chat_id, r.text, reply_markup=r.markup)
+                results.append((r, None))
+            except Exception as e:
+                results.append((r, e))
+        async with aengine.begin() as conn:
+            await conn.run_sync(core.settle_outbox, results, core.utcnow())
+        total += sum(1 for _, e in results if e is None)
+        if len(rows) < batch:
+            break
+    else:
+        core.OUTBOX_WAKE.poke()
+    return total
+
+async def deliver_now(*keys):
+    try:
+        await drain_outbox(list(keys), rounds=1)
+    except Exception as e:
+        log.error("outbox deliver error: %s", e)
+
+# ========= ЭКСПОРТ =========
+async def iter_export(sess, fmt, entities, user_id=None):
+    """Как core.iter_export, но через AsyncSession.stream (серверный курсор)."""
+    async def rows(entity):
+        res = await sess.stream(core.export_query(entity, user_id).execution_options(yield_per=core.CONFIG["EXPORT_CHUNK"]))
+        async for row in res.mappings():
+            yield row
+    if fmt == "jsonl":
+        for entity in entities:
+            async for row in rows(entity):
+                yield core.jsonl_line(entity, row)
+        return
+    (entity,) = entities
+    ch = core.CsvChunker()
+    cols = core.export_columns(entity)
+    yield ch.line(cols)
+    async for row in rows(entity):
+        yield ch.line([row[c] for c in cols])
+
+# ========= ХЕНДЛЕРЫ =========
+# Та же маршрутизация словарями, что и в sync (core.Router), но хендлеры — корутины.
+AROUTER = core.Router(get_state)
+AROUTER.hooks.append(core.trace_route)
+
+@abot.message_handler(func=lambda msg: True)
+async def on_message(m):
+    route = AROUTER.resolve_message(m)
+    if route:
+        await AROUTER.arun(route, m)
+
+@AROUTER.command("start")
+async def cmd_start(m):
+    async with ASession() as sess:
+        await ensure_user(sess, m.chat.id, name=m.from_user.full_name if m.from_user else "")
+    await abot.send_message(m.chat.id, "Привет! Я твой ассистент по задачам. Что делаем?", reply_markup=main_menu())
+
+@AROUTER.command("export")
+async def cmd_export(m):
+    uid = m.chat.id
+    args = (m.text or "").split()[1:]
+    fmt = args[0].lower() if args else "jsonl"
+    if fmt not in core.EXPORT_FORMATS:
+        await abot.send_message(uid, "Формат: /export jsonl или /export csv", reply_markup=main_menu()); return
+    batches = [core.EXPORT_ENTITIES] if fmt == "jsonl" else [(e,) for e in core.EXPORT_ENTITIES]
+    async with ASession() as sess, read_only(sess, uid):
+        for entities in batches:
+            name = f"{'tasksbot' if fmt == 'jsonl' else entities[0]}_{core.export_stamp()}.{fmt}"
+            with tempfile.TemporaryFile() as f:
+                async for chunk in iter_export(sess, fmt, entities, uid):
+                    f.write(chunk)
+                if f.tell() > core.TG_DOCUMENT_LIMIT:
+                    await abot.send_message(uid, f"{name}: файл больше 50 МБ, Telegram его не примет. Попроси админа выгрузить через /admin/export.")
+                    continue
+                f.seek(0)
+                await abot.send_document(uid, f, visible_file_name=name)
+
+@AROUTER.text("📅 Сегодня")
+async def handle_today(m):
+    uid = m.chat.id
+    today = now_local(uid).date()
+    async with ASession() as sess:
+        await ensure_user(sess, uid)
+        await expand_repeats_for_date(sess, uid, today)
+        async with read_only(sess, uid):
+            rows = await get_task_views(sess, core.q_tasks_for_date(uid, today))
+    date_label = dstr(today)
+    header = f"📅 Задачи на {date_label}\n\n{format_grouped(rows, header_date=date_label)}"
+    await abot.send_message(uid, header, reply_markup=main_menu())
+    if rows:
+        kb = core.page_kb([(short_task_line(t), t.id) for t in rows], 1)
+        await abot.send_message(uid, "Открой карточку:", reply_markup=kb)
+
+@AROUTER.text("📆 Неделя", "🗓 Вся неделя")
+async def handle_week(m):
+    uid = m.chat.id
+    today = now_local(uid).date()
+    async with ASession() as sess:
+        await ensure_user(sess, uid)
+        for i in range(7):
+            await expand_repeats_for_date(sess, uid, today+timedelta(days=i))
+        async with read_only(sess, uid):
+            rows = await get_task_views(sess, core.q_tasks_for_week(uid, today))
+    if not rows:
+        await abot.send_message(uid, "На неделю задач нет.", reply_markup=main_menu()); return
+    await abot.send_message(uid, core.week_text(rows), reply_markup=main_menu())
+
+# кнопки, которые только переводят в состояние и отвечают подсказкой
+PROMPTS = {
+    "➕ Добавить": ("adding_text", "Опиши задачу одним сообщением (я распаршу дату/время/категорию/ТТ)."),
+    "🔎 Найти": ("search_text", "Что ищем? Введи часть текста/категории/подкатегории/даты (ДД.ММ.ГГГГ)."),
+    "✅ Я сделал…": ("done_text", "Напиши что сделал. Примеры:\n<b>сделал заказы к-экспро центр</b>\n<b>сделал все заказы вылегжанина</b>"),
+    "🆕 Добавить поставщика": ("add_supplier", "Формат:\n<b>Название; правило; дедлайн(опц); emoji(опц); delivery_offset(опц); shelf_days(опц); auto(1/0); active(1/0)</b>\n"
+                                              "Примеры:\nК-Экспро; каждые 2 дня; 14:00; 📦; 1; 0; 1; 1\n"
+                                              "ИП Вылегжанина; shelf 72h; 14:00; 🥘; 1; 3; 1; 1"),
+    "🧠 Ассистент": ("assistant_text", "Что нужно? (спланировать день, выделить приоритеты, составить расписание и т.д.)"),
+}
+
+@AROUTER.text(*PROMPTS)
+async def handle_prompt(m):
+    state, text = PROMPTS[m.text]
+    set_state(m.chat.id, state)
+    await abot.send_message(m.chat.id, text)
+
+@AROUTER.text("🚚 Поставки")
+async def handle_supplies(m):
+    await abot.send_message(m.chat.id, "Меню поставок:", reply_markup=supplies_menu())
+
+@AROUTER.text("📦 Заказы сегодня")
+async def handle_today_orders(m):
+    uid = m.chat.id
+    async with ASession() as sess, read_only(sess, uid):
+        orders = await get_task_views(sess, core.q_orders_for_date(uid, now_local(uid).date()))
+    if not orders:
+        await abot.send_message(uid, "Сегодня заказов нет.", reply_markup=supplies_menu()); return
+    kb = types.InlineKeyboardMarkup()
+    for i,t in enumerate(orders, start=1):
+        kb.add(types.InlineKeyboardButton(short_task_line(t, i), callback_data=core.mk_cb("open", id=t.id)))
+    await abot.send_message(uid, "Заказы на сегодня:", reply_markup=kb)
+
+@AROUTER.text("⚙️ Настройки")
+async def handle_settings(m):
+    await abot.send_message(m.chat.id, core.settings_text(m.chat.id), reply_markup=core.settings_kb())
+
+@AROUTER.text("📊 Статистика")
+async def handle_stats(m):
+    uid = m.chat.id
+    week = core.week_start(now_local(uid).date())
+    async with ASession() as sess, read_only(sess, uid):
+        rows = (await sess.scalars(core.q_task_stats(uid, [week, week - timedelta(days=7)]))).all()
+    await abot.send_message(uid, core.stats_text(rows, week) + "\n\n" + core.stats_text(rows, week - timedelta(days=7)), reply_markup=main_menu())
+
+@AROUTER.text("⬅ Назад")
+async def handle_back(m):
+    clear_state(m.chat.id)
+    await abot.send_message(m.chat.id, "Главное меню:", reply_markup=main_menu())
+
+# ========= ТЕКСТОВЫЕ СОСТОЯНИЯ =========
+async def ai_parse_to_items(text, fallback_uid):
+    if aopenai:
+        try:
+            with core.span("openai", "parse"):
+                resp = await aopenai.chat.completions.create(**core.ai_parse_request(text))
+            return core.ai_items_from_json(resp.choices[0].message.content, fallback_uid)
+        except Exception as e:
+            log.error("AI parse failed: %s", e)
+    return core.ai_parse_fallback(text, fallback_uid)
+
+@AROUTER.state("adding_text")
+async def adding_text(m):
+    uid = m.chat.id
+    try:
+        items = await ai_parse_to_items(m.text.strip(), uid)
+        async with ASession() as sess:
+            await ensure_user(sess, uid)
+            created, dups = 0, []
+            for it in items:
+                date = parse_date_str(it["date"]) if it["date"] else now_local(uid).date()
+                tm   = parse_time_str(it["time"]) if it["time"] else None
+                fields = dict(user_id=uid, date=date,
+                              category=it["category"], subcategory=it["subcategory"],
+                              text=it["task"], deadline=tm,
+                              repeat_rule=it["repeat"], source=it["supplier"], is_repeating=bool(it["repeat"]))
+                dup = None if fields["is_repeating"] else await sess.run_sync(core.find_duplicate, uid, fields["text"], date)
+                if dup:
+                    dups.append(core.dup_prompt(uid, fields, *dup)); continue
+                await add_task(sess, **fields)
+                created += 1
+        if created or not dups:
+            await abot.send_message(uid, f"✅ Добавлено задач: {created}", reply_markup=main_menu())
+        for text, kb in dups:
+            await abot.send_message(uid, text, reply_markup=kb)
+    except Exception as e:
+        log.error("adding_text error: %s", e)
+        await abot.send_message(uid, "Не смог добавить. Попробуй иначе.", reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("search_text")
+async def search_text(m):
+    uid = m.chat.id
+    try:
+        q = m.text.strip().lower()
+        async with ASession() as sess, read_only(sess, uid):
+            found = [(short_task_line(t), t.id) for t in core.search_views(await sess.execute(core.q_search_rows(uid)), q)]
+        if not found:
+            await abot.send_message(uid, "Ничего не найдено.", reply_markup=main_menu()); return
+        await abot.send_message(uid, "Найденные задачи:", reply_markup=core.page_kb(found, 1))
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("done_text")
+async def done_text(m):
+    uid = m.chat.id
+    try:
+        txt = m.text.strip().lower()
+        supplier = core.detect_supplier(txt)
+        async with ASession() as sess:
+            rows = await get_tasks_for_date(sess, uid, now_local(uid).date())
+            changed = 0
+            last = None
+            for t in rows:
+                if t.status == "выполнено": continue
+                low = (t.text or "").lower()
+                if supplier and supplier.lower() not in low:
+                    continue
+                if not supplier and not any(w in low for w in ["заказ","сделал","закуп"]):
+                    continue
+                t.status = "выполнено"
+                last = t
+                changed += 1
+            msg = f"✅ Отмечено выполненным: {changed}."
+            if changed and supplier and last:
+                created = await plan_next_for_supplier(sess, uid, supplier, last.category, last.subcategory, commit=False)
+                if created:
+                    more = ", ".join([f"{'приемка' if k=='delivery' else 'заказ'} {dstr(v)}" for k,v in created])
+                    msg += f"\n🔮 Запланировано: {more}"
+            key = f"done:{uid}:{m.message_id}"
+            await enqueue(sess, uid, msg, key, "done", markup=main_menu())
+            await sess.commit()
+        await deliver_now(key)
+    except Exception as e:
+        log.error("done_text error: %s", e)
+        await abot.send_message(uid, "Не получилось отметить. Попробуй иначе.", reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("assistant_text")
+async def assistant_text(m):
+    uid = m.chat.id
+    try:
+        if not aopenai:
+            await abot.send_message(uid, core.ASSISTANT_FALLBACK, reply_markup=main_menu()); return
+        async with ASession() as sess, read_only(sess, uid):
+            rows = await get_task_views(sess, core.q_tasks_for_week(uid, now_local(uid).date()))
+        with core.span("openai", "assistant"):
+            resp = await aopenai.chat.completions.create(**core.assistant_request(m.text.strip(), rows))
+        answer = resp.choices[0].message.content.strip()
+        await abot.send_message(uid, f"🧠 {answer}", reply_markup=main_menu())
+    except Exception as e:
+        log.error("assistant error: %s", e)
+        await abot.send_message(uid, "Не смог получить ответ ассистента.", reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("add_supplier")
+async def add_supplier_text(m):
+    uid = m.chat.id
+    try:
+        form = core.parse_supplier_form(m.text)
+        async with ASession() as sess:
+            s = (await sess.scalars(select(Supplier).where(
+                func.lower(Supplier.name)==core.normalize_supplier_name(form["name"])))).first()
+            if not s:
+                sess.add(Supplier(**form))
+            else:
+                for k, v in form.items():
+                    if k != "name": setattr(s, k, v)
+            await sess.commit()
+            await sess.run_sync(core.replan_supplier, form["name"])
+        await abot.send_message(uid, f"✅ Поставщик «{form['name']}» сохранён.", reply_markup=supplies_menu())
+    except Exception as e:
+        log.error("add_supplier error: %s", e)
+        await abot.send_message(uid, "Не получилось сохранить поставщика.", reply_markup=supplies_menu())
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("add_sub_text")
+async def add_sub_text(m):
+    uid = m.chat.id
+    try:
+        tid = int(get_buf(uid).get("task_id"))
+        async with ASession() as sess:
+            if not await get_user_task(sess, tid, uid):
+                await abot.send_message(uid, "Задача не найдена.", reply_markup=main_menu()); return
+            sess.add(SubTask(task_id=tid, text=m.text.strip(), status=""))
+            await sess.commit()
+        await abot.send_message(uid, "Подзадача добавлена.", reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("set_deadline")
+async def set_deadline_text(m):
+    uid = m.chat.id
+    try:
+        tid = int(get_buf(uid).get("task_id"))
+        try:
+            t = parse_time_str(m.text.strip())
+        except Exception:
+            await abot.send_message(uid, "Нужен формат ЧЧ:ММ.", reply_markup=main_menu()); return
+        async with ASession() as sess:
+            task = await get_user_task(sess, tid, uid)
+            if not task:
+                await abot.send_message(uid, "Задача не найдена.", reply_markup=main_menu()); return
+            task.deadline = t
+            await sess.commit()
+        await abot.send_message(uid, "Дедлайн обновлён.", reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("set_reminder")
+async def set_reminder_text(m):
+    uid = m.chat.id
+    try:
+        tid = int(get_buf(uid).get("task_id"))
+        parts = m.text.strip().split()
+        if len(parts) != 2:
+            await abot.send_message(uid, "Формат: ДД.ММ.ГГГГ ЧЧ:ММ", reply_markup=main_menu()); return
+        ds, ts = parts
+        try:
+            async with ASession() as sess:
+                d, t = parse_date_str(ds), parse_time_str(ts)
+                sess.add(Reminder(user_id=uid, task_id=tid, date=d, time=t,
+                                  due_at=core.reminder_due_utc(core.PREFS.tz(uid), d, t), fired=False))
+                await sess.commit()
+            await abot.send_message(uid, f"⏰ Напоминание на {ds} {ts} установлено.", reply_markup=main_menu())
+        except Exception:
+            await abot.send_message(uid, "Не смог установить напоминание. Проверь формат.", reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("pick_delivery_date")
+async def pick_delivery_date(m):
+    uid = m.chat.id
+    try:
+        tid = int(get_buf(uid).get("task_id"))
+        ds  = m.text.strip()
+        try:
+            d = parse_date_str(ds)
+        except Exception:
+            await abot.send_message(uid, "Дата некорректна. Нужен формат ДД.ММ.ГГГГ.", reply_markup=main_menu()); return
+        async with ASession() as sess:
+            t = await get_user_task(sess, tid, uid)
+            if not t:
+                await abot.send_message(uid, "Задача не найдена.", reply_markup=main_menu()); return
+            await add_task(sess, **core.delivery_task_fields(t, d))
+        await abot.send_message(uid, f"Создано на {ds}.", reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+# ========= INLINE: карточка задачи и действия =========
+@abot.callback_query_handler(func=lambda c: True)
+async def cb_handler(c):
+    data = parse_cb(c.data) if c.data and c.data!="noop" else None
+    route = AROUTER.resolve_callback(data)
+    if not route:
+        await abot.answer_callback_query(c.id); return
+    await AROUTER.arun(route, c, data)
+
+@AROUTER.action("page")
+async def cb_page(c, data):
+    uid = c.message.chat.id
+    async with ASession() as sess, read_only(sess, uid):
+        rows = await get_task_views(sess, core.q_tasks_for_date(uid, now_local(uid).date()))
+    kb = core.page_kb([(short_task_line(t), t.id) for t in rows], int(data.get("p", 1)))
+    try:
+        await abot.edit_message_reply_markup(uid, c.message.message_id, reply_markup=kb)
+    except Exception:
+        pass
+    await abot.answer_callback_query(c.id)
+
+@AROUTER.action("open")
+async def cb_open(c, data):
+    uid = c.message.chat.id
+    async with ASession() as sess, read_only(sess, uid):
+        text, kb = core.task_card(await get_user_task(sess, int(data.get("id")), uid))
+    await abot.answer_callback_query(c.id)
+    await abot.send_message(uid, text, reply_markup=kb)
+
+@AROUTER.action("done")
+async def cb_done(c, data):
+    uid = c.message.chat.id
+    async with ASession() as sess:
+        t = await complete_task(sess, int(data.get("id")), uid)
+        if not t:
+            await abot.answer_callback_query(c.id, "Не удалось", show_alert=True); return
+        sup = core.detect_supplier(t.text)
+        msg = "✅ Готово."
+        if sup:
+            created = await plan_next_for_supplier(sess, uid, sup, t.category, t.subcategory)
+            if created:
+                msg += " Запланирована приемка/следующий заказ."
+    await abot.answer_callback_query(c.id, msg, show_alert=True)
+    text, kb = core.task_card(t)
+    await abot.edit_message_text(text, uid, c.message.message_id, reply_markup=kb)
+
+@AROUTER.action("accept_delivery")
+async def cb_accept_delivery(c, data):
+    tid = int(data.get("id"))
+    kb = types.InlineKeyboardMarkup()
+    kb.row(
+        types.InlineKeyboardButton("Сегодня", callback_data=core.mk_cb("accept_delivery_date", id=tid, d="today")),
+        types.InlineKeyboardButton("Завтра", callback_data=core.mk_cb("accept_delivery_date", id=tid, d="tomorrow")),
+    )
+    kb.row(types.InlineKeyboardButton("📅 Другая дата", callback_data=core.mk_cb("accept_delivery_pick", id=tid)))
+    await abot.answer_callback_query(c.id)
+    await abot.send_message(c.message.chat.id, "Когда принять поставку?", reply_markup=kb)
+
+@AROUTER.action("accept_delivery_date")
+async def cb_accept_delivery_date(c, data):
+    uid = c.message.chat.id
+    async with ASession() as sess:
+        t = await get_user_task(sess, int(data.get("id")), uid)
+        if not t:
+            await abot.answer_callback_query(c.id, "Задача не найдена", show_alert=True); return
+        d = now_local(uid).date() if data.get("d") == "today" else now_local(uid).date()+timedelta(days=1)
+        await add_task(sess, **core.delivery_task_fields(t, d))
+    await abot.answer_callback_query(c.id, f"Создано на {dstr(d)}", show_alert=True)
+
+@AROUTER.action(*core.PICK_STATES)
+async def cb_pick(c, data):
+    uid = c.message.chat.id
+    state, prompt = core.PICK_STATES[data.get("a")]
+    set_state(uid, state, {"task_id": int(data.get("id"))})
+    await abot.answer_callback_query(c.id)
+    await abot.send_message(uid, prompt)
+
+@AROUTER.action("delete")
+async def cb_delete(c, data):
+    uid = c.message.chat.id
+    async with ASession() as sess:
+        ok = await delete_task(sess, int(data.get("id")), uid)
+    await abot.answer_callback_query(c.id, "Удалено" if ok else "Не удалось", show_alert=True)
+    try:
+        await abot.delete_message(uid, c.message.message_id)
+    except Exception:
+        pass
+
+@AROUTER.action("dup")
+async def cb_dup(c, data):
+    uid = c.message.chat.id
+    pending = core.DUP_PENDING.get(uid, {}).pop(data.get("k"), None)
+    do = data.get("do") if pending else "stale"
+    async with ASession() as sess:
+        if do == "merge":
+            fields, dup_id = pending
+            t = await get_user_task(sess, dup_id, uid)
+            if t:
+                core.merge_duplicate(t, fields); await sess.commit()
+            else:
+                await add_task(sess, **fields); do = "gone"
+        elif do == "add":
+            await add_task(sess, **pending[0])
+    await abot.answer_callback_query(c.id, core.DUP_REPLIES.get(do, ""))
+    try:
+        await abot.edit_message_text(f"{c.message.text or ''}\n\n{core.DUP_REPLIES.get(do, '')}", uid, c.message.message_id)
+    except Exception:
+        pass
+
+@AROUTER.action(*core.SETTINGS_PROMPTS)
+async def cb_settings(c, data):
+    uid = c.message.chat.id
+    state, prompt = core.SETTINGS_PROMPTS[data.get("a")]
+    set_state(uid, state)
+    await abot.answer_callback_query(c.id)
+    await abot.send_message(uid, prompt)
+
+async def save_user_prefs(uid, **fields):
+    async with ASession() as sess:
+        u = await ensure_user(sess, uid)
+        for k, v in fields.items():
+            setattr(u, k, v)
+        if "tz" in fields:
+            await sess.run_sync(core.retime_reminders, uid, core.UserPrefs.resolve(u.tz, "")[0])
+        await sess.commit()
+    core.DIGESTS.schedule(uid, *core.PREFS.put(uid, u.tz, u.digest_time))
+
+@AROUTER.state("set_tz")
+async def set_tz_text(m):
+    uid = m.chat.id
+    try:
+        tz = core.parse_tz(m.text)
+        if not tz:
+            await abot.send_message(uid, "Не знаю такой пояс. Пример: Europe/Samara или +4.", reply_markup=main_menu()); return
+        await save_user_prefs(uid, tz=tz)
+        await abot.send_message(uid, "✅ Сохранено.\n" + core.settings_text(uid), reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+@AROUTER.state("set_digest_time")
+async def set_digest_time_text(m):
+    uid = m.chat.id
+    try:
+        dt = core.parse_digest_time(m.text)
+        if not dt:
+            await abot.send_message(uid, "Нужен формат ЧЧ:ММ или «выкл».", reply_markup=main_menu()); return
+        await save_user_prefs(uid, digest_time=dt)
+        await abot.send_message(uid, "✅ Сохранено.\n" + core.settings_text(uid), reply_markup=main_menu())
+    finally:
+        clear_state(uid)
+
+# ========= ПЛАНИРОВЩИКИ =========
+def ajob(fn):
+    """Как core.job_scope для корутин: каждая задача — своя трасса."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with core.trace("job:" + fn.__name__):
+            return await fn(*args, **kwargs)
+    return wrapper
+
+@ajob
+async def job_load_digests():
+    async with ASession() as sess:
+        core.load_digest_schedule((await sess.execute(select(User.id, User.tz, User.digest_time))).all())
+
+async def send_digest(sess, uid, today):
+    """Как core.send_digest."""
+    await expand_repeats_for_date(sess, uid, today)
+    async with read_only(sess, uid):
+        tasks = await get_task_views(sess, core.q_tasks_for_date(uid, today))
+        week = core.week_start(today) - timedelta(days=7)
+        report = (await sess.scalars(core.q_task_stats(uid, [week]))).all() if today.weekday() == 0 else []
+    if report:
+        await enqueue(sess, uid, core.stats_text(report, week), f"report:{uid}:{week.isoformat()}", "report")
+    if tasks:
+        await enqueue(sess, uid, core.digest_text(tasks, today), f"digest:{uid}:{today.isoformat()}", "digest")
+    await sess.commit()
+
+@ajob
+async def job_digest_tick():
+    """Как core.job_digest_tick: только пользователи из созревших бакетов."""
+    now = core.CLOCK.now()
+    due = core.DIGESTS.pop_due(now)
+    if not due:
+        return
+    async with ASession() as sess:
+        for uid in due:
+            tz, dt = core.digest_prefs(uid)
+            core.DIGESTS.schedule(uid, tz, dt, now)
+            if not dt:
+                continue
+            try:
+                await send_digest(sess, uid, now.astimezone(tz).date())
+            except Exception as e:
+                await sess.rollback()
+                log.error("digest for %s failed: %s", uid, e)
+
+@ajob
+async def job_load_reminders():
+    until = core.utcnow() + core.REMINDER_HORIZON
+    async with ASession() as sess:
+        core.REMINDERS.load((await sess.execute(core.q_due_reminders(until))).all(), until)
+
+@ajob
+async def job_reminders():
+    """Как core.job_reminders."""
+    due = core.REMINDERS.pop_due(core.utcnow())
+    if not due:
+        return
+    now = core.utcnow()
+    async with ASession() as sess:
+        for r in await sess.scalars(select(Reminder).where(Reminder.id.in_(due), Reminder.fired==False)):
+            if r.due_at > now:
+                core.REMINDERS.add([(r.id, r.due_at)])
+                continue
+            t = await get_user_task(sess, r.task_id, r.user_id)
+            if t:
+                await enqueue(sess, r.user_id, core.reminder_text(t), f"reminder:{r.id}", "reminder")
+            r.fired = True
+        await sess.commit()
+
+@ajob
+async def job_drain_outbox():
+    try:
+        await drain_outbox()
+    except Exception:
+        core.OUTBOX_WAKE.poke()
+        raise
+
+@ajob
+async def job_stats_rollover():
+    async with aengine.begin() as conn:
+        await conn.run_sync(core.rollover_task_stats, core.stats_closed_day())
+
+@ajob
+async def job_prune_updates():
+    async with ASession() as sess:
+        await sess.execute(delete(ProcessedUpdate).where(ProcessedUpdate.created_at < core.prune_updates_before()))
+        await sess.execute(delete(core.Outbox).where(core.Outbox.status!="pending",
+                                                     core.Outbox.created_at < core.outbox_prune_before()))
+        await sess.commit()
+
+@ajob
+async def job_plan_suppliers():
+    async with ASession() as sess:
+        if not await sess.scalar(select(func.count()).select_from(core.SupplierTarget)):
+            await sess.run_sync(core.bootstrap_supplier_targets)
+        await sess.run_sync(core.plan_supplier_calendar)
+
+@ajob
+async def job_sheets_sync():
+    """Как core.job_sheets_sync: проход sheets_sync (под его арендой) синхронным кодом поверх AsyncSession.
+    Без него журнал task_changes, который пишется при SHEETS_BACKEND, в async-режиме никто бы не разбирал."""
+    try:
+        import sheets_sync
+        backend = sheets_sync.backend_from_config(core.CONFIG)
+        async with ASession() as sess:
+            await sess.run_sync(sheets_sync.run_sync, backend)
+    except Exception as e:
+        log.error("sheets sync job error: %s", e)
+
+class AsyncScheduler(core.Scheduler):
+    """core.Scheduler для корутин: та же таблица задач (core.setup_scheduler), сроки и статистика."""
+    async def run_pending(self):
+        n = 0
+        for j in self.jobs:
+            if j[0] <= core.CLOCK.now():
+                await self.run(j[1])
+                self._advance(j)
+                n += 1
+        return n
+
+    async def run(self, job):
+        t0 = time.perf_counter()
+        try:
+            await job()
+        except Exception as e:
+            self._record(job, t0, e)
+        else:
+            self._record(job, t0)
+
+SCHEDULER = AsyncScheduler()
+
+async def scheduler_loop():
+    jobs = sys.modules[__name__]
+    SCHEDULER.jobs.clear()
+    core.setup_scheduler(SCHEDULER, jobs)
+    for job in core.startup_jobs(jobs):
+        await SCHEDULER.run(job)
+    while True:
+        await SCHEDULER.run_pending()
+        await asyncio.sleep(1)
+
+# ========= AIOHTTP/WEBHOOK =========
+_INFLIGHT = set()
+
+async def accept_update(upd):
+    """То же, что core.accept_update, но общая таблица processed_updates — через async engine."""
+    if core.DEDUP.seen(upd.update_id):
+        return False
+    if core.CONFIG["DEDUP_SHARED"]:
+        try:
+            async with aengine.begin() as conn:
+                await conn.execute(insert(ProcessedUpdate).values(update_id=upd.update_id))
+        except IntegrityError:
+            core.DEDUP.count("dropped_shared")
+            return False
+        except Exception as e:
+            log.error("dedup shared store error: %s", e)
+            core.DEDUP.count("shared_errors")
+    core.DEDUP.count("accepted")
+    return True
+
+async def admit_update(upd):
+    """Как core.admit_update, ответ на отбитый апдейт — через abot."""
+    a = core.update_action(upd, AROUTER.texts)
+    if a is None:
+        return True
+    chat_id, key, action, obj = a
+    verdict = core.ADMISSION.admit(chat_id, key, action)
+    if verdict == "ok":
+        obj._admitted_at = time.monotonic()
+        return True
+    reply = core.admission_reply(upd, chat_id, verdict)
+    if reply:
+        try:
+            await getattr(abot, reply[0])(*reply[1])
+        except Exception as e:
+            log.warning("admission reply error: %s", e)
+    return False
+
+async def _process(upd, sem):
+    async with sem:
+        if not await accept_update(upd):
+            log.info("duplicate update %s dropped", upd.update_id)
+            return
+        if not await admit_update(upd):
+            return
+        obj = upd.message or upd.callback_query
+        started = getattr(obj, "_admitted_at", None)
+        queued = round((time.monotonic() - started) * 1000.0, 2) if started is not None else None
+        try:
+            with core.trace("update", uid=obj.from_user.id if obj and obj.from_user else None, queued_ms=queued):
+                await abot.process_new_updates([upd])
+        finally:
+            if started is not None:
+                core.ADMISSION.done(started)
+
+async def webhook(request):
+    upd = types.Update.de_json(await request.text())
+    task = asyncio.create_task(_process(upd, request.app["inflight_sem"]))
+    _INFLIGHT.add(task)
+    task.add_done_callback(_INFLIGHT.discard)
+    return web.Response(text="OK")
+
+async def home(request):
+    return web.Response(text="TasksBot is running (async)")
+
+def admin_request_ok(request):
+    return core.admin_token_ok(request.headers.get("X-Admin-Token") or request.query.get("token"))
+
+async def debug_stats(request):
+    if not admin_request_ok(request):
+        raise web.HTTPNotFound()
+    return web.json_response(core.collect_stats())
+
+async def debug_slow(request):
+    if not admin_request_ok(request):
+        raise web.HTTPNotFound()
+    return web.json_response(core.RECORDER.snapshot(core.slow_limit(request.query)))
+
+def install_telegram_spans():
+    """Как core.install_telegram_spans, для asyncio_helper AsyncTeleBot."""
+    from telebot import asyncio_helper
+    orig = asyncio_helper._process_request
+    if getattr(orig, "_traced", False):
+        return
+    async def _process_request(token, url, method="get", params=None, files=None, **kwargs):
+        with core.span("telegram", url):
+            return await orig(token, url, method, params, files, **kwargs)
+    _process_request._traced = True
+    asyncio_helper._process_request = _process_request
+
+EXPORT_FLUSH_BYTES = 64 * 1024
+
+async def admin_export(request):
+    if not admin_request_ok(request):
+        raise web.HTTPNotFound()
+    parsed = core.parse_export_args(request.query)
+    if isinstance(parsed, str):
+        raise web.HTTPBadRequest(text=parsed)
+    fmt, entities, uid = parsed
+    name = f"{entities[0] if len(entities) == 1 else 'tasksbot'}_{core.export_stamp()}.{fmt}"
+    resp = web.StreamResponse(headers={"Content-Type": core.EXPORT_MIMETYPES[fmt],
+                                       "Content-Disposition": f"attachment; filename={name}"})
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    buf = bytearray()
+    async with ASession() as sess, read_only(sess):
+        async for chunk in iter_export(sess, fmt, entities, uid):
+            buf += chunk
+            if len(buf) >= EXPORT_FLUSH_BYTES:
+                await resp.write(bytes(buf)); buf.clear()
+    if buf:
+        await resp.write(bytes(buf))
+    await resp.write_eof()
+    return resp
+
+async def on_startup(app):
+    global aengine, aopenai
+    aengine = create_async_engine(async_db_url(core.DB_URL), **core.engine_kwargs(core.DB_URL, core.CONFIG))
+    core.instrument_engine(aengine.sync_engine, core.parse_pre_ping(core.CONFIG["DB_PRE_PING"]))
+    core.STATS_PROVIDERS["db"] = lambda: {**core.db_stats(), "pool": core.pool_stats(aengine.sync_engine)}
+    ASession.configure(bind=aengine)
+    for url in core.replica_urls(core.CONFIG["DATABASE_URL_RO"]):
+        eng = create_async_engine(async_db_url(url), **core.engine_kwargs(url, core.CONFIG))
+        core.instrument_engine(eng.sync_engine, core.parse_pre_ping(core.CONFIG["DB_PRE_PING"]))
+        areplicas.append(eng)
+    core.REPLICAS.configure([e.sync_engine for e in areplicas], core.CONFIG["DB_PIN_SEC"], core.CONFIG["DB_REPLICA_RETRY_SEC"])
+    async with aengine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(core.migrate_schema)
+    aopenai = make_async_openai(core.OPENAI_API_KEY)
+    app["inflight_sem"] = asyncio.Semaphore(core.CONFIG["ASYNC_MAX_INFLIGHT"])
+    app["scheduler"] = asyncio.create_task(scheduler_loop())
+
+async def on_cleanup(app):
+    app["scheduler"].cancel()
+    if _INFLIGHT:
+        await asyncio.gather(*_INFLIGHT, return_exceptions=True)
+    await abot.close_session()
+    await aengine.dispose()
+    for eng in areplicas:
+        await eng.dispose()
+
+def create_async_app(config=None):
+    cfg = core.load_config(config)
+    if not cfg["TELEGRAM_TOKEN"] or not cfg["WEBHOOK_BASE"] or not cfg["DATABASE_URL"]:
+        raise RuntimeError("Нужны ENV: TELEGRAM_TOKEN, WEBHOOK_BASE, DATABASE_URL")
+    core.apply_config(cfg)
+    abot.token = core.API_TOKEN
+    core.DEDUP.resize(cfg["DEDUP_SIZE"])
+    core.ADMISSION.configure(cfg)
+    core.RECORDER.configure(cfg)
+    install_telegram_spans()
+    core.STATS_PROVIDERS["routes"] = lambda: AROUTER.stats()
+    core.STATS_PROVIDERS["scheduler"] = lambda: SCHEDULER.snapshot()
+    app = web.Application()
+    app.router.add_post("/" + core.WEBHOOK_SECRET, webhook)
+    app.router.add_get("/", home)
+    app.router.add_get("/debug/stats", debug_stats)
+    app.router.add_get("/debug/slow", debug_slow)
+    app.router.add_get("/admin/export", admin_export)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def main():
+    web.run_app(create_async_app(), host="0.0.0.0", port=core.PORT)
+
+if __name__ == "__main__":
+    main()